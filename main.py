@@ -1,4 +1,5 @@
 from math import sin
+from random import random
 from processing import *
 
 # This is a map creation program/puzzle/adventure game for GWC 2024!
@@ -22,41 +23,49 @@ chosen_level = None  # Set this to a level name to bypass level select (should h
 # they should do). Feel free to create brand new tiles!
 
 class TileType(object):
+  # Tiles have no state of their own (everything lives in the Block), so a block just stores the class and
+  # calls these classmethods with itself as the block argument.
   color = (0, 0, 0)
-  def __init__(self, block):
-    self.block = block
+  # Most tiles only need these two to decide whether the player can step on: whether it can be walked on at all,
+  # and an item the player needs to do it (None if anyone can). Override can_enter for anything fancier.
+  passable = True
+  required_item = None
 
-  def can_enter(self, player):
-    return True
+  @classmethod
+  def can_enter(cls, player, block):
+    return cls.passable and (cls.required_item is None or player.has(cls.required_item))
     
-  def can_leave(self, player):
+  @classmethod
+  def can_leave(cls, player, block):
     return True
     
-  def enter(self, player):
+  @classmethod
+  def enter(cls, player, block):
     return
     
-  def leave(self, player):
+  @classmethod
+  def leave(cls, player, block):
     return
-  
-  def draw(self, map):
-    stroke(255, 255, 255, 100)
-    fill(*self.color)
-    rect(self.block.x*map.grid_square_length, self.block.y*map.grid_square_height,
-         map.grid_square_length, map.grid_square_height, 0)
+
+  @classmethod
+  def landing(cls, map, player, block, dx, dy):
+    # Where the player ends up after stepping onto this block of map while moving by (dx, dy). Only tiles that
+    # move the player on (like Teleporter) need to change this; Map.reachable uses it to follow them.
+    return block.x, block.y
     
   
 class Ice(TileType):
   color = (230, 230, 255)
-  def leave(self, player):
-    self.block.set_tile(Water(self.block))
+  @classmethod
+  def leave(cls, player, block):
+    block.set_tile(Water)
     
 class Water(TileType):
   color = (140, 140, 255)
-
-  def can_enter(self, player):
-    return player.has("flippers")
+  required_item = "flippers"
   
-  def enter(self, player):
+  @classmethod
+  def enter(cls, player, block):
     player.hydration = 100
     
 class Grass(TileType):
@@ -65,8 +74,7 @@ class Grass(TileType):
 class Rock(TileType):
   # Rock cannot be passed through (optional: without a pickaxe). Test in any level but demo
   color = (120, 100, 140)
-  def can_enter(self, player):
-    return False
+  passable = False
   
 class RockFloor(TileType):
   color = (80, 60, 100)
@@ -75,12 +83,31 @@ class RockFloor(TileType):
 class Teleporter(TileType):
   # Teleporters skip the player forward 3 blocks in the direction they entered. Test in teleport_across
   color = (255, 0, 210)
+  distance = 3
+
+  @classmethod
+  def enter(cls, player, block):
+    dx, dy = directions[player.move_direction]
+    x, y = cls.landing(player.map, player, block, dx, dy)
+    if (x, y) != (block.x, block.y):
+      player.move_to(x, y)
+
+  @classmethod
+  def landing(cls, map, player, block, dx, dy):
+    x = block.x + dx*cls.distance
+    y = block.y + dy*cls.distance
+    if not map.can_move(player, x, y):
+      return block.x, block.y
+    # Landing on another teleporter (or anything else that moves you on) carries on from there
+    dest = map.blocks[y][x]
+    return dest.tiletype.landing(map, player, dest, dx, dy)
   
 # Cedalia
 class Sludge(TileType):
   # Sludge damages the player when stepped on, but is turned to rock floor right after. Test in sludge_lavafields
   color = (180, 90, 120)
-  def enter(self, player):
+  @classmethod
+  def enter(cls, player, block):
     player.health -= 8
     # print("You stamp out the sludge, but it deals some damage. Health: {}".format(player.health))
     print("You step on the sludge and it deals some damage. Health: {}".format(player.health))
@@ -104,6 +131,14 @@ class OneTimeHeal(TileType):
 class QuickSand(TileType):
   # Quicksand has a %chance of not being able to exit. Test in quicksand
   color = (220, 175, 100)
+  stuck_chance = 0.3
+
+  @classmethod
+  def can_leave(cls, player, block):
+    if random() < cls.stuck_chance:
+      print("You're stuck in the quicksand!")
+      return False
+    return True
 
 
 ######## ITEMS ########
@@ -122,15 +157,6 @@ class Item(object):
     
   def enter(self, player):
     return
-  
-  def draw(self, map):
-    stroke(255)
-    fill(*self.color)
-    item_margin = map.grid_square_length / 4
-    rect(self.block.x*map.grid_square_length + item_margin,
-         self.block.y*map.grid_square_height + item_margin,
-         map.grid_square_length - item_margin*2,
-         map.grid_square_height - item_margin*2, 0)
     
 class Key(Item):
   item_name = "key"
@@ -143,48 +169,55 @@ class Key(Item):
 
 ########################################### ADDITIONAL CLASSES ##################################################
 
+# Blocks that changed since the last redraw. Map.redraw_dirty() repaints only these.
+dirty_blocks = set()
+
 class Block(object):
   # An individual block on the map. Contains a tile, zero or one items, and possibly the player.
-  has_player = False
+  # There's one of these per grid square, so __slots__ keeps each one a small fixed-size record.
+  __slots__ = ("tiletype", "item", "x", "y", "has_player", "dirty")
   
-  def __init__(self, tilegen, item, x, y):
-    self.tiletype = tilegen(self)
-    self.item = item(self)
+  def __init__(self, x, y):
+    # The tile and item are filled in from the map template by Map.reset()
+    self.tiletype = None
+    self.item = None
     # These are used ONLY to do the draw call.
     # we can't (seemingly?) return a canvas like we could in js to be drawn at some position, so kludge
     self.x = x
     self.y = y
+    self.has_player = False
+    self.dirty = True
+
+  def mark_dirty(self):
+    self.dirty = True
+    dirty_blocks.add(self)
     
   def can_enter(self, player):
-    return self.tiletype.can_enter(player)
+    return self.tiletype.can_enter(player, self)
   
   def can_leave(self, player):
-    return self.tiletype.can_leave(player)
+    return self.tiletype.can_leave(player, self)
 
   def enter(self, player):
-    self.tiletype.enter(player)
-    if self.item:
-      self.item.enter(player)
     self.has_player = True
-    self.draw(player.map)
+    self.mark_dirty()
+    self.tiletype.enter(player, self)
+    # The tile may have moved the player on already (e.g. Teleporter), in which case they never reach the item
+    if self.item and self.has_player:
+      self.item.enter(player)
     
   def leave(self, player):
-    self.tiletype.leave(player)
+    self.tiletype.leave(player, self)
     self.has_player = False
-    self.draw(player.map)
+    self.mark_dirty()
     
   def set_tile(self, tiletype):
     self.tiletype = tiletype
+    self.mark_dirty()
     
   def set_item(self, item):
     self.item = item
-    
-  def draw(self, map):
-    self.tiletype.draw(map)
-    if self.item:
-      self.item.draw(map)
-    if self.has_player:
-      map.draw_player(self.x, self.y)
+    self.mark_dirty()
 
   
 class Map(object):
@@ -192,32 +225,140 @@ class Map(object):
   def __init__(self, map_name, player):
     self.name = map_name
     map_template = maps[map_name]
+    self.template = map_template
     self.win_condition = map_template["win_condition"]
     map_height = len(map_template["terrain"])
     map_width = len(map_template["terrain"][0])
+    self.width = map_width
+    self.height = map_height
     self.grid_square_length = screen_side_length/map_width
     self.grid_square_height = screen_side_length/map_height
-    self.blocks = []
-    for y in range(map_height):
-      row = []
-      for x in range(map_width):
-        block = Block(terrain[map_template["terrain"][y][x]],
-                      item[map_template["items"][y][x]],
-                      x, y)
-        if x == player.x and y == player.y:
-          block.has_player = True
-        block.draw(self)
-        row.append(block)
-      self.blocks.append(row)
+    # The grid never moves, so work out where everything goes on screen once instead of on every draw.
+    gsl = self.grid_square_length
+    gsh = self.grid_square_height
+    self.px = [x*gsl for x in range(map_width)]
+    self.py = [y*gsh for y in range(map_height)]
+    item_margin = gsl / 4
+    self.item_offset = item_margin
+    self.item_w = gsl - item_margin*2
+    self.item_h = gsh - item_margin*2
+    player_margin = gsl / 1.5
+    self.player_offset = player_margin
+    self.player_w = gsl - player_margin*2
+    self.player_h = gsh - player_margin*2
+    # The blocks are made empty here and filled in from the template by reset()
+    self.blocks = [[Block(x, y) for x in range(map_width)] for y in range(map_height)]
+    self.item_blocks = {}  # (x, y) -> block, for the few blocks that start with an item
+    self.reset(player)
+
+  def reset(self, player):
+    # Puts every block back the way the template has it and redraws, reusing the blocks we already have.
+    # Used to restart a level without building a whole new Map.
+    terrain_rows = self.template["terrain"]
+    item_rows = self.template["items"]
+    self.item_blocks = {}
+    for y in range(self.height):
+      terrain_row = terrain_rows[y]
+      item_row = item_rows[y]
+      for block in self.blocks[y]:
+        x = block.x
+        item_id = item_row[x]
+        block.tiletype = terrain[terrain_row[x]]
+        block.item = item[item_id](block) if item_id else None
+        block.has_player = False
+        if block.item:
+          self.item_blocks[(x, y)] = block
+    self.blocks[player.y][player.x].has_player = True
+    self.draw_all()
+
+  def draw_all(self):
+    # Paints every block once, e.g. after the map is built.
+    dirty_blocks.clear()
+    self.draw_blocks([block for row in self.blocks for block in row], self.item_blocks.values())
+
+  def redraw_dirty(self):
+    # Repaints only the blocks that changed since the last redraw (usually the old and new player block).
+    blocks = [block for block in dirty_blocks if block.dirty]
+    self.draw_blocks(blocks, blocks)
+    dirty_blocks.clear()
+
+  def draw_blocks(self, blocks, item_blocks):
+    # Groups blocks by color so fill() is only called once per color instead of once per block:
+    # tiles first, then items on top, then the player. Items are only looked for in item_blocks, which
+    # can be much shorter than blocks since most squares are empty.
+    px = self.px
+    py = self.py
+    tile_buckets = {}
+    item_buckets = {}
+    player_block = None
+    for block in blocks:
+      tile_buckets.setdefault(block.tiletype.color, []).append(block)
+      if block.has_player:
+        player_block = block
+      block.dirty = False
+    for block in item_blocks:
+      if block.item:
+        item_buckets.setdefault(block.item.color, []).append(block)
+    tile_w = self.grid_square_length
+    tile_h = self.grid_square_height
+    stroke(255, 255, 255, 100)
+    for color, bucket in tile_buckets.items():
+      fill(*color)
+      for block in bucket:
+        rect(px[block.x], py[block.y], tile_w, tile_h, 0)
+    stroke(255)
+    offset = self.item_offset
+    item_w = self.item_w
+    item_h = self.item_h
+    for color, bucket in item_buckets.items():
+      fill(*color)
+      for block in bucket:
+        rect(px[block.x] + offset, py[block.y] + offset, item_w, item_h, 0)
+    if player_block:
+      self.draw_player(player_block.x, player_block.y)
       
+  def can_move(self, player, x, y):
+    # Whether the player may step onto (x, y): it has to be on the map and its block has to let them in.
+    return (0 <= x < self.width and 0 <= y < self.height
+            and self.blocks[y][x].can_enter(player))
+
+  def reachable(self, player, x, y):
+    # Breadth-first search from (x, y): returns the set of (x, y) squares the player could walk to with what
+    # they're carrying right now. It's optimistic: it ignores can_leave (quicksand always lets you out
+    # eventually) and tiles changing under you (ice melting behind you). Chained teleporters are followed to
+    # the square the player finally stops on, but items sitting on the teleporters in between don't count.
+    seen = set([(x, y)])
+    queue = [(x, y)]
+    head = 0
+    while head < len(queue):
+      x, y = queue[head]
+      head += 1
+      for dx, dy in directions.values():
+        new_x = x + dx
+        new_y = y + dy
+        if not self.can_move(player, new_x, new_y):
+          continue
+        block = self.blocks[new_y][new_x]
+        landing = block.tiletype.landing(self, player, block, dx, dy)
+        if landing not in seen:
+          seen.add(landing)
+          queue.append(landing)
+    return seen
+
+  def validate(self, player):
+    # Whether every item on the map can be reached from where the player is standing. Useful for checking
+    # a new map: call player.map.validate(player) right after the level starts.
+    reachable = self.reachable(player, player.x, player.y)
+    for pos, block in self.item_blocks.items():
+      if block.item and pos not in reachable:
+        return False
+    return True
+
   def draw_player(self, x, y):
     stroke(255)
     fill(100, 100, 100)
-    item_margin = self.grid_square_length / 1.5
-    rect(x*self.grid_square_length + item_margin,
-         y*self.grid_square_height + item_margin,
-         self.grid_square_length - item_margin*2,
-         self.grid_square_height - item_margin*2, 0)
+    rect(self.px[x] + self.player_offset, self.py[y] + self.player_offset,
+         self.player_w, self.player_h, 0)
 
  
 class Player(object):
@@ -228,15 +369,20 @@ class Player(object):
   # check health, end game if <=0 (die): DONE
   # have inventory (currency?): DONE
   # change world on tilestep: DONE
-  health = 100
-  currency = 0
-  hydration = 100
-  inventory = []
-  x = 0
-  y = 0
-  map = None
-  game_over = False
-  chosen_level = None
+  def __init__(self):
+    self.health = 100
+    self.currency = 0
+    self.hydration = 100
+    self.inventory = {}  # item name -> how many the player holds
+    # Win conditions only look at the inventory, so they're only re-checked after it changes
+    self.inventory_changed = True
+    self.has_won = False
+    self.x = 0
+    self.y = 0
+    self.map = None
+    self.move_direction = None
+    self.game_over = False
+    self.chosen_level = None
   
   def choose_level(self):
     print("Available levels: {}".format(", ".join(maps.keys())))
@@ -248,14 +394,22 @@ class Player(object):
     self.y = maps[self.chosen_level]["player_start_y"]
     self.health = 100
     self.currency = 0
-    self.inventory = []
-    self.map = Map(self.chosen_level, player)
+    self.inventory = {}
+    self.inventory_changed = True
+    if self.map and self.map.name == self.chosen_level:
+      self.map.reset(self)
+    else:
+      self.map = Map(self.chosen_level, self)
    
   def has(self, item_name):
-    return item_name in self.inventory
+    return self.count(item_name) > 0
+
+  def count(self, item_name):
+    return self.inventory.get(item_name, 0)
       
   def claim(self, item_name):
-    self.inventory.append(item_name)
+    self.inventory[item_name] = self.count(item_name) + 1
+    self.inventory_changed = True
     print("Picked up {}".format(item_name))
     
   def win(self):
@@ -270,6 +424,13 @@ class Player(object):
     text("YOU LOSE...", screen_side_length * 0.26, screen_side_length * 0.5)
     self.game_over = True
        
+  def move_to(self, x, y):
+    # Moves the player from their block to the one at (x, y), which may move them again (see Teleporter).
+    self.map.blocks[self.y][self.x].leave(self)
+    self.x = x
+    self.y = y
+    self.map.blocks[y][x].enter(self)
+
   def take_turn(self, dir):
     if self.game_over:
       self.chosen_level = None
@@ -280,57 +441,64 @@ class Player(object):
     self.move_direction = dir
     if not self.map.blocks[self.y][self.x].can_leave(self):
       return
-    new_x = self.x
-    new_y = self.y
-    if dir == "left":
-      new_x -= 1
-    elif dir == "right":
-      new_x += 1
-    elif dir == "up":
-      new_y -= 1
-    elif dir == "down":
-      new_y += 1
-    if (new_x > -1 and new_x < len(self.map.blocks)
-        and new_y > -1 and new_y < len(self.map.blocks[0])
-        and self.map.blocks[new_y][new_x].can_enter(self)):
-      self.map.blocks[self.y][self.x].leave(self)
-      self.map.blocks[new_y][new_x].enter(self)
-      self.x = new_x
-      self.y = new_y
+    dx, dy = directions[dir]
+    new_x = self.x + dx
+    new_y = self.y + dy
+    if self.map.can_move(self, new_x, new_y):
+      self.move_to(new_x, new_y)
+      self.map.redraw_dirty()
     if self.health <= 0:
       self.lose()
     if self.hydration < 10:
       self.health -= 2
       print("You are dehydrated. Health: {}".format(player.health))
-    if self.map.win_condition(self):
+    if self.inventory_changed:
+      self.has_won = self.map.win_condition(self)
+      self.inventory_changed = False
+    if self.has_won:
       self.win()
 
+  def take_turns(self, dirs):
+    # Plays a whole sequence of moves (e.g. ["down", "down", "left"]), stopping when the game ends.
+    # Handy for replaying a solution or testing a map without pressing keys.
+    for dir in dirs:
+      self.take_turn(dir)
+      if self.game_over:
+        return
+
 #####################################################################################################################
 
 ##################################################### DATA #######################################################
 
+directions = {
+  "left": (-1, 0),
+  "right": (1, 0),
+  "up": (0, -1),
+  "down": (0, 1),
+}
+
 terrain = {
-  0: lambda x: Grass(x),
-  1: lambda x: Ice(x),
-  2: lambda x: Water(x),
-  3: lambda x: Rock(x),
-  4: lambda x: RockFloor(x),
-  5: lambda x: Teleporter(x),
-  6: lambda x: Sludge(x),
-  7: lambda x: Lava(x),
-  8: lambda x: HealBlock(x),
-  9: lambda x: OneTimeHeal(x),
-  10: lambda x: QuickSand(x)
+  0: Grass,
+  1: Ice,
+  2: Water,
+  3: Rock,
+  4: RockFloor,
+  5: Teleporter,
+  6: Sludge,
+  7: Lava,
+  8: HealBlock,
+  9: OneTimeHeal,
+  10: QuickSand
 }
 
 item = {
-  0: lambda x: None,
-  1: lambda x: Key(x),
+  0: None,
+  1: Key,
 }
 
 maps ={
   "demo": {"player_start_x": 2, "player_start_y": 0,
-    "win_condition": lambda x: x.inventory.count("key") == 3,
+    "win_condition": lambda x: x.count("key") == 3,
     "terrain": [
      [2, 2, 1, 2, 2, 2],
      [2, 1, 1, 2, 2, 2],
@@ -347,7 +515,7 @@ maps ={
      [0, 0, 0, 0, 1, 0]
      ]},
   "quicksand": {"player_start_x": 3, "player_start_y": 1,
-    "win_condition": lambda x: x.inventory.count("key") == 3,
+    "win_condition": lambda x: x.count("key") == 3,
     "terrain": [
      [10, 10, 10, 10, 10],
      [10, 10, 10, 10, 10],
@@ -362,7 +530,7 @@ maps ={
      [0, 0, 0, 1, 0]
      ]},
   "teleport_across": {"player_start_x": 3, "player_start_y": 3,
-    "win_condition": lambda x: x.inventory.count("key") == 1,
+    "win_condition": lambda x: x.count("key") == 1,
     "terrain": [
      [0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 3, 3, 4, 4],
      [0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 3, 3, 4, 4],
@@ -397,7 +565,7 @@ maps ={
      [0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0]
      ]},
   "sludge_lavafields": {"player_start_x": 3, "player_start_y": 0,
-    "win_condition": lambda x: x.inventory.count("key") == 2,
+    "win_condition": lambda x: x.count("key") == 2,
     "terrain": [
      [6, 6, 6, 4, 6, 6, 7],
      [6, 7, 7, 7, 6, 6, 7],
@@ -416,7 +584,7 @@ maps ={
      [0, 0, 0, 0, 0, 0, 0]
      ]},
   "heal_corridor": {"player_start_x": 0, "player_start_y": 1,
-    "win_condition": lambda x: x.inventory.count("key") == 1,
+    "win_condition": lambda x: x.count("key") == 1,
     "terrain": [
      [3, 3, 3, 3, 3, 3, 3],
      [4, 6, 6, 6, 6, 6, 3],